@@ -1,24 +1,32 @@
 from flask import Flask, request, jsonify, send_from_directory, render_template
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
+from string import Template
 import yaml
 from datetime import datetime
-import subprocess
-from PIL import Image
+from PIL import Image, ImageOps, ExifTags
 import uuid
 import os
+import io
+import logging
+import re
+import time
+import atexit
+import threading
+import make
 
 CONFIG_PATH = Path("config.yaml")
 
-if CONFIG_PATH.exists():
-    with open(CONFIG_PATH) as f:
-        CONFIG = yaml.safe_load(f)
-else:
-    CONFIG = {}
+CONFIG = make.load_config() if CONFIG_PATH.exists() else {}
 
 EDITOR_HOST = CONFIG.get("editor", {}).get("host", "127.0.0.1")
 EDITOR_PORT = CONFIG.get("editor", {}).get("port", 5000)
 
+IMAGE_MAX_AGE = CONFIG.get("editor", {}).get("image_max_age", 31536000)
+
 app = Flask(__name__)
+app.config["USE_X_SENDFILE"] = CONFIG.get("editor", {}).get("x_sendfile", False)
 
 POSTS_DIR = Path("content/posts")
 IMAGES_DIR = Path("content/images")
@@ -28,32 +36,170 @@ IMAGES_DIR.mkdir(parents=True, exist_ok=True)
 MAX_WIDTH = CONFIG.get("images", {}).get("max_width", 1280)
 MAX_HEIGHT = CONFIG.get("images", {}).get("max_height", 1280)
 JPEG_QUALITY = CONFIG.get("images", {}).get("jpeg_quality", 80)
+RESAMPLE_FILTERS = {
+    "lanczos": Image.LANCZOS,
+    "bicubic": Image.BICUBIC,
+    "bilinear": Image.BILINEAR,
+    "box": Image.BOX,
+}
+RESAMPLE = CONFIG.get("images", {}).get("resample")
+if RESAMPLE and RESAMPLE not in RESAMPLE_FILTERS:
+    raise ValueError(f"images.resample must be one of {', '.join(RESAMPLE_FILTERS)}, got {RESAMPLE!r}")
+REDUCING_GAP = CONFIG.get("images", {}).get("reducing_gap", 2.0)
 
-def list_posts():
-    posts = []
-    for f in POSTS_DIR.glob("*.md"):
-        content = f.read_text(encoding="utf-8")
-        metadata = {}
-        if content.startswith("---"):
+def pick_resample(img):
+    if RESAMPLE:
+        return RESAMPLE_FILTERS[RESAMPLE]
+    ratio = max(img.width / MAX_WIDTH, img.height / MAX_HEIGHT)
+    return Image.BILINEAR if ratio <= 2 else Image.LANCZOS
+
+NEW_POST_TEMPLATE = Template("""---
+title: $title
+subtitle: Write your description here.
+date: $today
+unlisted: false
+---
+
+Write your content here.
+""")
+
+ISO_DATE_RE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+YAML_LOADER = make.YAML_LOADER
+
+_POSTS_CACHE = {}
+_POSTS_POOL = ThreadPoolExecutor(max_workers=8)
+
+_BUILD_POOL = ThreadPoolExecutor(max_workers=1)
+_BUILD_JOBS = {}
+_BUILD_JOBS_LOCK = threading.Lock()
+MAX_FINISHED_BUILD_JOBS = 20
+
+SAVE_INTERVAL = 0.25
+_PENDING_SAVES = {}
+_FAILED_SAVES = {}
+_SAVE_LOCK = threading.Lock()
+_FLUSH_LOCK = threading.Lock()
+
+def write_post(path, content):
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def flush_saves():
+    with _FLUSH_LOCK:
+        with _SAVE_LOCK:
+            pending = dict(_PENDING_SAVES)
+        for filename, content in pending.items():
+            error = None
             try:
-                _, meta_block, _ = content.split("---", 2)
-                metadata = yaml.safe_load(meta_block)
-            except Exception:
-                pass
-        date_str = metadata.get("date", "")
+                write_post(POSTS_DIR / filename, content)
+            except Exception as e:
+                app.logger.exception("Failed to save %s", filename)
+                error = str(e)
+            with _SAVE_LOCK:
+                if _PENDING_SAVES.get(filename) is content:
+                    del _PENDING_SAVES[filename]
+                    if error:
+                        _FAILED_SAVES[filename] = (content, error)
+            _POSTS_CACHE.pop(filename, None)
+
+def discard_pending_save(filename):
+    with _FLUSH_LOCK, _SAVE_LOCK:
+        _PENDING_SAVES.pop(filename, None)
+        _FAILED_SAVES.pop(filename, None)
+
+def save_worker():
+    while True:
+        time.sleep(SAVE_INTERVAL)
+        flush_saves()
+
+threading.Thread(target=save_worker, daemon=True).start()
+atexit.register(flush_saves)
+
+def parse_front_matter(head):
+    if not head.startswith(b"---"):
+        return {}
+    end = head.find(b"\n---", 3)
+    if end == -1:
+        return {}
+    return yaml.load(head[3:end].decode("utf-8"), Loader=YAML_LOADER)
+
+def read_front_matter(f):
+    with f.open("rb") as fh:
+        head = fh.read(4096)
+        if head.startswith(b"---") and head.find(b"\n---", 3) == -1:
+            head += fh.read()
+    return parse_front_matter(head)
+
+def read_post(f, content=None):
+    metadata = {}
+    try:
+        if content is None:
+            metadata = read_front_matter(f)
+        else:
+            metadata = parse_front_matter(content.encode("utf-8"))
+    except Exception:
+        pass
+    date_str = metadata.get("date", "")
+    if ISO_DATE_RE.match(str(date_str).strip()):
+        date_str = str(date_str).strip()
+    else:
         try:
             date_obj = datetime.strptime(str(date_str).strip(), "%Y-%m-%d")
             date_str = date_obj.strftime("%Y-%m-%d")
         except Exception:
             pass
-        slug = f.stem
-        posts.append({
-            "filename": f.name,
-            "title": metadata.get("title", f.stem),
-            "date": date_str,
-            "slug": slug
-        })
-    return sorted(posts, key=lambda x: x["date"], reverse=True)
+    slug = f.stem
+    return {
+        "filename": f.name,
+        "title": metadata.get("title", f.stem),
+        "date": date_str,
+        "slug": slug
+    }
+
+def load_post(entry):
+    mtime = entry.stat().st_mtime_ns
+    cached = _POSTS_CACHE.get(entry.name)
+    if cached is not None and cached[0] == mtime:
+        return cached
+    return (mtime, read_post(Path(entry.path)))
+
+def list_posts():
+    with os.scandir(POSTS_DIR) as it:
+        entries = [e for e in it if e.name.endswith(".md") and e.is_file()]
+    posts = {}
+    cache = {}
+    for entry, cached in zip(entries, _POSTS_POOL.map(load_post, entries)):
+        cache[entry.name] = cached
+        posts[entry.name] = cached[1]
+    _POSTS_CACHE.clear()
+    _POSTS_CACHE.update(cache)
+    with _SAVE_LOCK:
+        pending = dict(_PENDING_SAVES)
+        failed = dict(_FAILED_SAVES)
+    for filename, (content, error) in failed.items():
+        if filename.endswith(".md"):
+            posts[filename] = {**read_post(POSTS_DIR / filename, content), "save_error": error}
+    for filename, content in pending.items():
+        if filename.endswith(".md"):
+            posts[filename] = read_post(POSTS_DIR / filename, content)
+    return sorted(posts.values(), key=itemgetter("date"), reverse=True)
+
+def scan_images(folder, slug):
+    images = []
+    with os.scandir(folder) as it:
+        for entry in it:
+            if "." in entry.name and entry.is_file():
+                images.append({
+                    "filename": entry.name,
+                    "url": f"/images/{slug}/{entry.name}",
+                    "size": entry.stat().st_size
+                })
+    return images
 
 def list_images(slug=None):
     images = []
@@ -61,24 +207,14 @@ def list_images(slug=None):
         folder = IMAGES_DIR / slug
         if not folder.exists():
             return []
-        for f in folder.glob("*.*"):
-            if f.is_file():
-                images.append({
-                    "filename": f.name,
-                    "url": f"/images/{slug}/{f.name}",
-                    "size": f.stat().st_size
-                })
+        images = scan_images(folder, slug)
     else:
-        for folder in IMAGES_DIR.glob("*"):
-            if folder.is_dir():
-                for f in folder.glob("*.*"):
-                    if f.is_file():
-                        images.append({
-                            "filename": f.name,
-                            "url": f"/images/{folder.name}/{f.name}",
-                            "size": f.stat().st_size,
-                            "slug": folder.name
-                        })
+        with os.scandir(IMAGES_DIR) as it:
+            for folder in it:
+                if folder.is_dir():
+                    for image in scan_images(folder.path, folder.name):
+                        image["slug"] = folder.name
+                        images.append(image)
     return sorted(images, key=lambda x: x["filename"], reverse=True)
 
 @app.route("/")
@@ -91,19 +227,32 @@ def api_posts():
 
 @app.route("/api/post/<filename>", methods=["GET"])
 def api_get_post(filename):
-    path = POSTS_DIR / filename
-    if not path.exists():
-        return jsonify({"error": "not found"}), 404
-    return jsonify({"content": path.read_text(encoding="utf-8")})
+    error = None
+    with _SAVE_LOCK:
+        content = _PENDING_SAVES.get(filename)
+        if content is None and filename in _FAILED_SAVES:
+            content, error = _FAILED_SAVES[filename]
+    if content is None:
+        path = POSTS_DIR / filename
+        if not path.exists():
+            return jsonify({"error": "not found"}), 404
+        content = path.read_text(encoding="utf-8")
+    if error:
+        return jsonify({"content": content, "save_error": error})
+    return jsonify({"content": content})
 
 @app.route("/api/post/<filename>", methods=["POST"])
 def api_save_post(filename):
     data = request.json
-    (POSTS_DIR / filename).write_text(data["content"], encoding="utf-8")
-    return jsonify({"status": "saved"})
+    with _SAVE_LOCK:
+        _PENDING_SAVES[filename] = data["content"]
+        _FAILED_SAVES.pop(filename, None)
+    _POSTS_CACHE.pop(filename, None)
+    return jsonify({"status": "queued"}), 202
 
 @app.route("/api/delete/<filename>", methods=["DELETE"])
 def api_delete_post(filename):
+    discard_pending_save(filename)
     path = POSTS_DIR / filename
     if not path.exists():
         return jsonify({"error": "not found"}), 404
@@ -114,6 +263,7 @@ def api_delete_post(filename):
             f.unlink()
         img_folder.rmdir()
     path.unlink()
+    _POSTS_CACHE.pop(filename, None)
     return jsonify({"status": "deleted"})
 
 @app.route("/api/new", methods=["POST"])
@@ -123,16 +273,10 @@ def api_new_post():
     slug = title.lower().replace(" ", "-")
     filename = f"{slug}.md"
     today = datetime.now().strftime("%Y-%m-%d")
-    template = f"""---
-title: {title}
-subtitle: Write your description here.
-date: {today}
-unlisted: false
----
-
-Write your content here.
-"""
+    template = NEW_POST_TEMPLATE.substitute(title=title, today=today)
+    discard_pending_save(filename)
     (POSTS_DIR / filename).write_text(template, encoding="utf-8")
+    _POSTS_CACHE.pop(filename, None)
     return jsonify({"filename": filename, "slug": slug})
 
 @app.route("/api/upload_image/<slug>", methods=["POST"])
@@ -143,8 +287,15 @@ def api_upload_image(slug):
     unique_name = f"{uuid.uuid4().hex}.jpg"
     save_path = folder / unique_name
     img = Image.open(file.stream)
+    orientation = img.getexif().get(ExifTags.Base.Orientation, 1)
+    if orientation in (5, 6, 7, 8):
+        img.draft("RGB", (MAX_HEIGHT, MAX_WIDTH))
+    else:
+        img.draft("RGB", (MAX_WIDTH, MAX_HEIGHT))
+    if orientation != 1:
+        img = ImageOps.exif_transpose(img)
     img = img.convert("RGB")
-    img.thumbnail((MAX_WIDTH, MAX_HEIGHT), Image.LANCZOS)
+    img.thumbnail((MAX_WIDTH, MAX_HEIGHT), pick_resample(img), reducing_gap=REDUCING_GAP)
     img.save(save_path, "JPEG", quality=JPEG_QUALITY, optimize=True)
     return jsonify({
         "status": "uploaded",
@@ -164,28 +315,61 @@ def api_delete_image(slug, filename):
     path.unlink()
     return jsonify({"status": "deleted"})
 
+def run_build():
+    stdout, stderr = io.StringIO(), io.StringIO()
+    stdout_handler = logging.StreamHandler(stdout)
+    stdout_handler.addFilter(lambda record: record.levelno < logging.WARNING)
+    stderr_handler = logging.StreamHandler(stderr)
+    stderr_handler.setLevel(logging.WARNING)
+    make.log.addHandler(stdout_handler)
+    make.log.addHandler(stderr_handler)
+    returncode = 0
+    try:
+        flush_saves()
+        make.main()
+    except Exception:
+        make.log.exception("Build failed")
+        returncode = 1
+    finally:
+        make.log.removeHandler(stdout_handler)
+        make.log.removeHandler(stderr_handler)
+    return stdout.getvalue(), stderr.getvalue(), returncode
+
 @app.route("/api/regenerate", methods=["POST"])
 def api_regenerate():
+    job_id = uuid.uuid4().hex
+    with _BUILD_JOBS_LOCK:
+        finished = [job for job, future in _BUILD_JOBS.items() if future.done()]
+        for job in finished[:-MAX_FINISHED_BUILD_JOBS]:
+            _BUILD_JOBS.pop(job, None)
+        _BUILD_JOBS[job_id] = _BUILD_POOL.submit(run_build)
+    return jsonify({"job_id": job_id}), 202
+
+@app.route("/api/regenerate/<job_id>", methods=["GET"])
+def api_regenerate_status(job_id):
+    with _BUILD_JOBS_LOCK:
+        future = _BUILD_JOBS.get(job_id)
+        if future is None:
+            return jsonify({"error": "not found"}), 404
+        if not future.done():
+            return jsonify({"status": "running"})
+        _BUILD_JOBS.pop(job_id, None)
     try:
-        result = subprocess.run(
-            ["python", "make.py"],
-            capture_output=True,
-            text=True,
-            check=False
-        )
-        return jsonify({
-            "stdout": result.stdout,
-            "stderr": result.stderr,
-            "returncode": result.returncode
-        })
+        stdout, stderr, returncode = future.result()
     except Exception as e:
         return jsonify({"error": str(e)}), 500
+    return jsonify({
+        "status": "done",
+        "stdout": stdout,
+        "stderr": stderr,
+        "returncode": returncode
+    })
 
 @app.route("/images/<slug>/<path:filename>")
 def serve_image(slug, filename):
-    return send_from_directory(IMAGES_DIR / slug, filename)
+    return send_from_directory(IMAGES_DIR / slug, filename, max_age=IMAGE_MAX_AGE)
 
 if __name__ == "__main__":
     print(f"Starting editor on {EDITOR_HOST}:{EDITOR_PORT}")
-    app.run(debug=True, host=EDITOR_HOST, port=EDITOR_PORT)
+    app.run(debug=os.environ.get("FLASK_ENV") == "dev", host=EDITOR_HOST, port=EDITOR_PORT)
 
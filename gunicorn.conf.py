@@ -0,0 +1,9 @@
+from pathlib import Path
+import make
+
+CONFIG = make.load_config() if Path(make.CONFIG_PATH).exists() else {}
+
+bind = f"{CONFIG.get('editor', {}).get('host', '127.0.0.1')}:{CONFIG.get('editor', {}).get('port', 5000)}"
+workers = 1
+worker_class = "gthread"
+threads = 8
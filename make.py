@@ -1,32 +1,79 @@
 import math
+import mmap
+import os
 import hashlib
 import json
-import subprocess
+import logging
+import shutil
+import time
+import mimetypes
+import boto3
 import markdown
 import yaml
 from pathlib import Path
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
 from datetime import datetime
 from xml.sax.saxutils import escape
+from urllib.parse import quote
+from boto3.s3.transfer import TransferConfig, create_transfer_manager
 
 CONFIG_PATH = "config.yaml"
+CONFIG_CACHE_PATH = ".config_cache.json"
 HASHES_PATH = ".file_hashes.json"
+BUILD_CACHE_PATH = ".build_cache.json"
+PENDING_UPLOADS_PATH = ".pending_uploads.json"
+JINJA_CACHE_DIR = Path(".jinja_cache")
+MAX_INVALIDATION_PATHS = 1000
 CONTENT_DIR = Path("content/posts")
 CONTENT_IMG_DIR = Path("content/images")
 IMAGE_DIR = Path("static/images")
 OUTPUT_DIR = Path("dist")
 TEMPLATE_DIR = Path("templates")
 
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+log = logging.getLogger("make")
+log.setLevel(logging.INFO)
+
 def load_config():
+    config_cache = Path(CONFIG_CACHE_PATH)
+    if config_cache.exists() and config_cache.stat().st_mtime_ns > Path(CONFIG_PATH).stat().st_mtime_ns:
+        with open(config_cache) as f:
+            return json.load(f)
     with open(CONFIG_PATH) as f:
-        return yaml.safe_load(f)
+        config = yaml.load(f, Loader=YAML_LOADER)
+    tmp = config_cache.with_name(config_cache.name + ".tmp")
+    with open(tmp, 'w') as f:
+        json.dump(config, f, default=str)
+    os.replace(tmp, config_cache)
+    return config
 
 def compute_hash(file_path):
-    hash_md5 = hashlib.md5()
     with open(file_path, 'rb') as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return hashlib.blake2b(b"", digest_size=16).hexdigest()
+        with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as mm:
+            return hashlib.blake2b(mm, digest_size=16).hexdigest()
+
+def hash_config(config):
+    return hashlib.blake2b(json.dumps(config, sort_keys=True, default=str).encode(), digest_size=16).hexdigest()
+
+def list_files(directory, suffix=None):
+    if not directory.exists():
+        return []
+    with os.scandir(directory) as it:
+        return [
+            Path(entry.path) for entry in it
+            if (entry.name.endswith(suffix) if suffix else "." in entry.name) and entry.is_file()
+        ]
+
+def list_content_images():
+    if not CONTENT_IMG_DIR.exists():
+        return []
+    with os.scandir(CONTENT_IMG_DIR) as it:
+        folders = [Path(entry.path) for entry in it if entry.is_dir()]
+    return [image for folder in folders for image in list_files(folder)]
 
 def load_hashes():
     return json.load(open(HASHES_PATH)) if Path(HASHES_PATH).exists() else {}
@@ -35,76 +82,161 @@ def save_hashes(hashes):
     with open(HASHES_PATH, 'w') as f:
         json.dump(hashes, f, indent=2)
 
-def build_content():
+def load_build_cache():
+    return json.load(open(BUILD_CACHE_PATH)) if Path(BUILD_CACHE_PATH).exists() else {}
+
+def save_build_cache(cache):
+    with open(BUILD_CACHE_PATH, 'w') as f:
+        json.dump(cache, f)
+
+def load_pending_uploads():
+    return json.load(open(PENDING_UPLOADS_PATH)) if Path(PENDING_UPLOADS_PATH).exists() else []
+
+def save_pending_uploads(keys):
+    with open(PENDING_UPLOADS_PATH, 'w') as f:
+        json.dump(keys, f, indent=2)
+
+def build_content(current_hashes):
+    cache = load_build_cache()
+    new_cache = {}
     posts = []
+    changed_slugs = set()
+    listing_changed = False
     md = markdown.Markdown(extensions=['meta'])
-    for md_file in CONTENT_DIR.glob("*.md"):
-        html = md.convert(md_file.read_text())
-        metadata = {k: v[0] for k, v in md.Meta.items()}
+    for md_file in list_files(CONTENT_DIR, ".md"):
         slug = md_file.stem
-        date_obj = datetime.strptime(metadata['date'], "%Y-%m-%d")
-        metadata['date_readable'] = date_obj.strftime("%B %d, %Y")
+        file_hash = current_hashes[str(md_file)]
+        cached = cache.get(slug)
+        if cached is None or cached.get('hash') != file_hash:
+            html = md.convert(md_file.read_text())
+            metadata = {k: v[0] for k, v in md.Meta.items()}
+            md.reset()
+            date_obj = datetime.strptime(metadata['date'], "%Y-%m-%d")
+            metadata['date_readable'] = date_obj.strftime("%B %d, %Y")
+            if cached is None or cached['meta'] != metadata:
+                listing_changed = True
+            cached = {"hash": file_hash, "content": html, "meta": metadata}
+            changed_slugs.add(slug)
+        new_cache[slug] = cached
         posts.append({
-            "content": html,
-            "meta": metadata,
+            "content": cached['content'],
+            "meta": cached['meta'],
             "slug": slug
         })
-    return sorted(posts, key=lambda x: x['meta']['date'], reverse=True)
+    if cache.keys() != new_cache.keys():
+        listing_changed = True
+    posts = sorted(posts, key=lambda x: x['meta']['date'], reverse=True)
+    return posts, new_cache, changed_slugs, listing_changed
 
-def render_templates(posts, config):
-    env = Environment(loader=FileSystemLoader(TEMPLATE_DIR))
+def render_templates(posts, config, changed_slugs, render_index):
+    JINJA_CACHE_DIR.mkdir(exist_ok=True)
+    env = Environment(
+        loader=FileSystemLoader(TEMPLATE_DIR),
+        bytecode_cache=FileSystemBytecodeCache(str(JINJA_CACHE_DIR)),
+        auto_reload=False,
+        cache_size=400
+    )
     OUTPUT_DIR.mkdir(exist_ok=True, parents=True)
     POSTS_PER_PAGE = config['website']['posts_per_page']
+    written = []
 
-    listed_posts = [p for p in posts if p['meta'].get('unlisted', '').lower() != 'true']
-    total_pages = math.ceil(len(listed_posts) / POSTS_PER_PAGE)
-
-    index_template = env.get_template("index.html")
-    for page_num in range(1, total_pages + 1):
-        start_idx = (page_num - 1) * POSTS_PER_PAGE
-        end_idx = start_idx + POSTS_PER_PAGE
-        paginated_posts = listed_posts[start_idx:end_idx]
-        page_filename = "index.html" if page_num == 1 else f"page{page_num}.html"
-        (OUTPUT_DIR / page_filename).write_text(
-            index_template.render(
+    if render_index:
+        listed_posts = [p for p in posts if p['meta'].get('unlisted', '').lower() != 'true']
+        total_pages = math.ceil(len(listed_posts) / POSTS_PER_PAGE)
+
+        index_template = env.get_template("index.html", globals={"config": config})
+        for page_num in range(1, total_pages + 1):
+            start_idx = (page_num - 1) * POSTS_PER_PAGE
+            end_idx = start_idx + POSTS_PER_PAGE
+            paginated_posts = listed_posts[start_idx:end_idx]
+            page_filename = "index.html" if page_num == 1 else f"page{page_num}.html"
+            written.append(OUTPUT_DIR / page_filename)
+            index_template.stream(
                 posts=paginated_posts,
-                config=config,
                 current_page=page_num,
                 total_pages=total_pages
-            )
-        )
+            ).dump(str(OUTPUT_DIR / page_filename), encoding="utf-8")
 
-    post_template = env.get_template("post.html")
+        generate_rss_feed(posts, OUTPUT_DIR, config)
+        written.append(OUTPUT_DIR / "feed.xml")
+
+    post_template = env.get_template("post.html", globals={"config": config})
     posts_dir = OUTPUT_DIR / "posts"
     posts_dir.mkdir(exist_ok=True)
     for post in posts:
+        if post['slug'] not in changed_slugs:
+            continue
         post_file = posts_dir / f"{post['slug']}.html"
-        post_file.write_text(post_template.render(post=post, config=config))
-
-    generate_rss_feed(posts, OUTPUT_DIR, config)
+        post_template.stream(post=post).dump(str(post_file), encoding="utf-8")
+        written.append(post_file)
+    return written
 
-def copy_static_assets():
+def copy_static_assets(changed):
     assets_dir = OUTPUT_DIR / "images"
     assets_dir.mkdir(exist_ok=True, parents=True)
-    for image in IMAGE_DIR.glob("*.*"):
-        (assets_dir / image.name).write_bytes(image.read_bytes())
-    (OUTPUT_DIR / "style.css").write_text((Path("static/style.css")).read_text())
+    written = []
+    for image in list_files(IMAGE_DIR):
+        target = assets_dir / image.name
+        if str(image) in changed or not target.exists():
+            shutil.copyfile(image, target)
+            written.append(target)
+    style = OUTPUT_DIR / "style.css"
+    if "style" in changed or not style.exists():
+        shutil.copyfile("static/style.css", style)
+        written.append(style)
+    return written
 
-def copy_content_images():
+def copy_content_images(changed):
     output_images_dir = OUTPUT_DIR / "images"
     output_images_dir.mkdir(exist_ok=True, parents=True)
-    for image in CONTENT_IMG_DIR.glob("*/*.*"):
+    written = []
+    for image in list_content_images():
         relative_path = image.relative_to(CONTENT_IMG_DIR)
         target_dir = output_images_dir / relative_path.parent
-        target_dir.mkdir(parents=True, exist_ok=True)
-        (target_dir / image.name).write_bytes(image.read_bytes())
+        target = target_dir / image.name
+        if str(image) in changed or not target.exists():
+            target_dir.mkdir(parents=True, exist_ok=True)
+            shutil.copyfile(image, target)
+            written.append(target)
+    return written
 
-def sync_s3_and_invalidate(config):
+def sync_s3_and_invalidate(config, paths):
     bucket = config['aws']['s3_bucket']
     dist_id = config['aws']['cloudfront_dist_id']
-    subprocess.run(["aws", "s3", "sync", str(OUTPUT_DIR), f"s3://{bucket}", "--acl", "public-read"], check=True)
-    subprocess.run(["aws", "cloudfront", "create-invalidation", "--distribution-id", dist_id, "--paths", "/*"], check=True)
-    print("Upload complete and CloudFront invalidated.")
+    keys = set(load_pending_uploads()) | {p.relative_to(OUTPUT_DIR).as_posix() for p in paths}
+    keys = sorted(key for key in keys if (OUTPUT_DIR / key).exists())
+    if not keys:
+        log.info("No output files changed; skipping upload.")
+        return
+    save_pending_uploads(keys)
+    transfer_config = TransferConfig(max_concurrency=16, multipart_threshold=8 * 1024 * 1024)
+    with create_transfer_manager(boto3.client("s3"), transfer_config) as manager:
+        futures = [
+            manager.upload(
+                str(OUTPUT_DIR / key), bucket, key,
+                extra_args={
+                    "ACL": "public-read",
+                    "ContentType": mimetypes.guess_type(key)[0] or "binary/octet-stream"
+                }
+            )
+            for key in keys
+        ]
+        for future in futures:
+            future.result()
+    invalidation_paths = ["/" + quote(key) for key in keys]
+    if "index.html" in keys:
+        invalidation_paths.append("/")
+    if len(invalidation_paths) > MAX_INVALIDATION_PATHS:
+        invalidation_paths = ["/*"]
+    boto3.client("cloudfront").create_invalidation(
+        DistributionId=dist_id,
+        InvalidationBatch={
+            "Paths": {"Quantity": len(invalidation_paths), "Items": invalidation_paths},
+            "CallerReference": str(time.time())
+        }
+    )
+    Path(PENDING_UPLOADS_PATH).unlink(missing_ok=True)
+    log.info(f"Uploaded {len(keys)} files and invalidated CloudFront.")
 
 def generate_rss_feed(posts, output_dir, config, feed_size=25):
     rss_items = []
@@ -141,24 +273,35 @@ def main():
     config = load_config()
     hashes = load_hashes()
     current_hashes = {
+        "config": hash_config(config),
         "index_template": compute_hash(TEMPLATE_DIR / "index.html"),
         "post_template": compute_hash(TEMPLATE_DIR / "post.html"),
         "style": compute_hash(Path("static/style.css")),
-        **{str(p): compute_hash(p) for p in CONTENT_DIR.glob("*.md")},
-        **{str(p): compute_hash(p) for p in IMAGE_DIR.glob("*.*")},
-        **{str(p): compute_hash(p) for p in CONTENT_IMG_DIR.glob("*/*.*")}
+        **{str(p): compute_hash(p) for p in list_files(CONTENT_DIR, ".md")},
+        **{str(p): compute_hash(p) for p in list_files(IMAGE_DIR)},
+        **{str(p): compute_hash(p) for p in list_content_images()}
     }
-    if hashes != current_hashes:
-        posts = build_content()
-        render_templates(posts, config)
-        copy_static_assets()
-        copy_content_images()
-        sync_s3_and_invalidate(config)
+    full_build = not OUTPUT_DIR.exists()
+    if full_build:
+        hashes = {}
+    changed = {k for k, v in current_hashes.items() if hashes.get(k) != v}
+    if changed or hashes.keys() != current_hashes.keys():
+        full_render = full_build or "config" in changed
+        posts, build_cache, changed_slugs, listing_changed = build_content(current_hashes)
+        if full_render or "post_template" in changed:
+            changed_slugs = {p['slug'] for p in posts}
+        render_index = full_render or listing_changed or "index_template" in changed
+        written = render_templates(posts, config, changed_slugs, render_index)
+        written += copy_static_assets(changed)
+        written += copy_content_images(changed)
+        sync_s3_and_invalidate(config, written)
+        save_build_cache(build_cache)
         save_hashes(current_hashes)
-        print("Site rebuilt and deployed.")
+        log.info("Site rebuilt and deployed.")
     else:
-        print("No changes detected; skipping build.")
+        log.info("No changes detected; skipping build.")
 
 if __name__ == "__main__":
+    logging.basicConfig(format="%(message)s")
     main()
 